@@ -1,14 +1,21 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+import numpy as np
 import datetime
-import pytz
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo
 import plotly.express as px
 import plotly.graph_objects as go
 from base64 import b64encode
 import json
+import orjson
+import re
 import urllib.parse
 import os
+import time
 import warnings
 
 
@@ -23,9 +30,37 @@ CLIENT_SECRET = st.secrets["ebay"]["CLIENT_SECRET"]
 # Encode credentials
 credentials = b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
 
-# Get OAuth2 token
-@st.cache_data(ttl=3600)
+# Timezone for displaying auction end times
+CENTRAL_TZ = ZoneInfo("America/Chicago")
+
+# Shared pooled adapter so api.ebay.com connections are kept alive across reruns
+@st.cache_resource
+def get_http_adapter():
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False
+    )
+    return HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries)
+
+HTTP_ADAPTER = get_http_adapter()
+
+def new_http_session():
+    # requests.Session isn't documented as thread-safe (shared cookie jar) and Streamlit
+    # runs each browser session in its own thread, so every call gets its own session on
+    # the shared adapter, whose urllib3 pool is thread-safe. Sessions are not closed;
+    # that would close the shared adapter.
+    session = requests.Session()
+    session.mount("https://", HTTP_ADAPTER)
+    return session
+
+# Get OAuth2 token, reusing the one in session state until shortly before it expires
 def get_access_token():
+    token = st.session_state.get('_ebay_token')
+    if token and time.time() < token['expires_at'] - 60:
+        return token['access_token']
+
     token_url = "https://api.ebay.com/identity/v1/oauth2/token"
     headers = {
         "Content-Type": "application/x-www-form-urlencoded",
@@ -35,74 +70,114 @@ def get_access_token():
         "grant_type": "client_credentials",
         "scope": "https://api.ebay.com/oauth/api_scope"
     }
-    response = requests.post(token_url, headers=headers, data=data)
-    return response.json().get("access_token")
+    response = new_http_session().post(token_url, headers=headers, data=data)
+    token_data = orjson.loads(response.content)
+
+    access_token = token_data.get("access_token")
+    if access_token:
+        st.session_state['_ebay_token'] = {
+            'access_token': access_token,
+            'expires_at': time.time() + token_data.get("expires_in", 7200)
+        }
+    return access_token
 
 access_token = get_access_token()
 
-# Seller categorization function
-def categorize_seller(feedback_score, feedback_percent):
-    try:
-        score = int(feedback_score) if feedback_score is not None else 0
-        percent = float(feedback_percent) if feedback_percent is not None else 0
-    except (ValueError, TypeError):
-        return "Uncategorized"
-    
-    if score >= 5000 and percent >= 99:
-        return "Elite"
-    elif score >= 1000 and percent >= 98:
-        return "Excellent"
-    elif score >= 500 and percent >= 97:
-        return "Very Good"
-    elif score >= 100 and percent >= 95:
-        return "Good"
-    elif score >= 100 and percent >= 90:
-        return "Average"
-    elif score < 100 and percent >= 90:
-        return "Inexperienced"
-    elif percent < 90:
-        return "Low Rated"
-    else:
-        return "Uncategorized"
+# Browse API returns at most this many items per request
+EBAY_PAGE_SIZE = 100
+
+def fetch_ebay_page(params, headers):
+    response = new_http_session().get(
+        "https://api.ebay.com/buy/browse/v1/item_summary/search",
+        params=params,
+        headers=headers
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content).get("itemSummaries", [])
+
+# Search listings, cached so reruns with the same search skip the API calls
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_ebay(query, filter_str, limit, category_ids=None):
+    page_size = min(limit, EBAY_PAGE_SIZE)
+    params = {
+        "q": query,
+        "filter": filter_str,
+        "limit": page_size
+    }
+    if category_ids:
+        params["category_ids"] = category_ids
 
-# Function to check if seller is a charity store
-def is_charity_seller(seller_username):
-    """Check if seller is a charity store (various charity organizations)"""
-    if not seller_username:
-        return False
-    
-    seller_lower = seller_username.lower()
-    
-    # Common charity store names to look for
-    charity_keywords = [
-        "goodwill",
-        "shopsastores",
-        "salvationarmy", 
-        "salvation_army",
-        "habitat", 
-        "habitatrestore",
-        "habitatforhumanity",
-        "faith_resale_online",
-        "vaporthriftonline",
-        "nonprofit",
-        "svdp", 
-        "stvincentdepaul", 
-        "vincentdepaul",
-        "catholiccharities", 
-        "catholiccharity",
-        "oxfam",
-        "barnardos",
-        "britishheartfoundation",
-        "bhf",
-        "redcross",
-        "charity",
-        "charities",
-        "thriftstoreusa",
-        "charitythrift",
-        "nonprofitstore"
+    headers = {
+        "Authorization": f"Bearer {get_access_token()}",
+        "Content-Type": "application/json"
+    }
+
+    offsets = range(0, limit, page_size)
+    if len(offsets) == 1:
+        return fetch_ebay_page(params, headers)
+
+    # Request all result pages at once over the pooled connections
+    with ThreadPoolExecutor(max_workers=len(offsets)) as executor:
+        pages = executor.map(
+            lambda offset: fetch_ebay_page({**params, "offset": offset}, headers),
+            offsets
+        )
+        items = [item for page in pages for item in page]
+
+    return items[:limit]
+
+# Seller categorization function
+def categorize_sellers(feedback_scores, feedback_percents):
+    """Categorize sellers from feedback score and percentage columns"""
+    score = pd.to_numeric(feedback_scores, errors='coerce').fillna(0)
+    percent = pd.to_numeric(feedback_percents, errors='coerce').fillna(0)
+
+    conditions = [
+        (score >= 5000) & (percent >= 99),
+        (score >= 1000) & (percent >= 98),
+        (score >= 500) & (percent >= 97),
+        (score >= 100) & (percent >= 95),
+        (score >= 100) & (percent >= 90),
+        (score < 100) & (percent >= 90),
+        percent < 90
     ]
-    
-    return any(keyword in seller_lower for keyword in charity_keywords)
+    choices = ["Elite", "Excellent", "Very Good", "Good", "Average", "Inexperienced", "Low Rated"]
+
+    return np.select(conditions, choices, default="Uncategorized")
+
+# Common charity store names to look for. Names that contain one of these
+# (e.g. "habitatforhumanity", "stvincentdepaul", "catholiccharities", "charitythrift",
+# "nonprofitstore") already match, so they are left out of the alternation.
+charity_keywords = (
+    "barnardos",
+    "bhf",
+    "britishheartfoundation",
+    "charities",
+    "charity",
+    "faith_resale_online",
+    "goodwill",
+    "habitat",
+    "nonprofit",
+    "oxfam",
+    "redcross",
+    "salvation_army",
+    "salvationarmy",
+    "shopsastores",
+    "svdp",
+    "thriftstoreusa",
+    "vaporthriftonline",
+    "vincentdepaul"
+)
+
+# Single alternation so seller names are scanned once instead of once per keyword
+CHARITY_RE = re.compile("|".join(map(re.escape, charity_keywords)), re.IGNORECASE)
+
+# Response parsing helper
+def get_column(frame, name, default=None):
+    """Get a flattened response column, filled with a default if no item has it"""
+    if name in frame.columns:
+        return frame[name]
+    return pd.Series(default, index=frame.index, dtype=object)
 
 # Functions for saved searches
 def save_current_search(search_params):
@@ -132,47 +207,63 @@ def delete_saved_search(index):
         del st.session_state.saved_searches[index]
 
 # Price analytics functions
+@st.cache_data(show_spinner=False, max_entries=8)
+def compute_price_stats(prices):
+    """Compute price averages and the deal mask, cached per result set"""
+    avg_price = prices.mean()
+    return {
+        "avg": avg_price,
+        "median": prices.median(),
+        # Items priced 15% below average
+        "deal_mask": (prices < avg_price * 0.85).to_numpy()
+    }
+
 def create_price_analytics(df):
     """Create price analytics dashboard"""
     if df.empty:
         return
     
+    stats = compute_price_stats(df['price'])
+    avg_price = stats["avg"]
+    median_price = stats["median"]
+    deal_mask = stats["deal_mask"]
+    deals = df.loc[deal_mask]
+
     # Metrics row
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        avg_price = df['price'].mean()
         st.metric("Average Price", f"${avg_price:.2f}")
     
     with col2:
-        median_price = df['price'].median()
         st.metric("Median Price", f"${median_price:.2f}")
     
     with col3:
-        deal_count = len(df[df['price'] < (avg_price * 0.85)])
+        deal_count = int(deal_mask.sum())
         st.metric("Potential Deals", f"{deal_count} item(s)", 
                  help="Items priced 15% below average")
     
     # Highlight best deals
     st.subheader("🎯 Best Deals (15% below average)")
-    deals = df[df['price'] < (avg_price * 0.85)]
     if not deals.empty:
-        # Convert back to formatted prices for display
-        deals_display = df[df.index.isin(deals.index)].copy()
-        deals_display['savings'] = deals_display.index.map(
-            lambda x: f"${avg_price - df.loc[x, 'price']:.2f}"
-        )
+        deals_display = deals.assign(savings=avg_price - deals['price'])
         st.dataframe(
             deals_display[['listing', 'condition', 'price', 'savings', 'seller', 'seller_rating', 'seller_feedback', 'link']],
             column_config={
                 "link": st.column_config.LinkColumn("Link", display_text="View Deal"),
-                "price": st.column_config.NumberColumn("price", format="$%.2f")
+                "price": st.column_config.NumberColumn("price", format="$%.2f"),
+                "savings": st.column_config.NumberColumn("savings", format="$%.2f")
             },
             use_container_width=True
         )
     else:
         st.info("No significant deals found in current results.")
 
+# Export helper, cached so reruns with the same results reuse the CSV bytes
+@st.cache_data(show_spinner=False, max_entries=8)
+def to_csv_bytes(df):
+    return df.to_csv(index=False).encode("utf-8")
+
 # UI
 st.title("eBay Product Listings")
 st.write("Fetch latest eBay listings by category, type, and max price.")
@@ -225,24 +316,45 @@ category_options = {
     "Vinyl Records": "176985"
 }
 
+# Selectbox options with their positions, so loaded values map to an index with a dict lookup
+CATEGORY_KEYS = tuple(category_options.keys())
+CATEGORY_INDEX = {key: i for i, key in enumerate(CATEGORY_KEYS)}
+
+LISTING_TYPES = ("All", "Auction", "Fixed Price", "Best Offer")
+LISTING_TYPE_INDEX = {key: i for i, key in enumerate(LISTING_TYPES)}
+
+SELLER_TYPES = ("All", "Charity")
+SELLER_TYPE_INDEX = {key: i for i, key in enumerate(SELLER_TYPES)}
+
+# Session state keys that load_saved_search can set for the widgets below
+LOADED_KEYS = (
+    "loaded_category",
+    "loaded_listing_type",
+    "loaded_seller_type",
+    "loaded_seller_rating",
+    "loaded_search_term",
+    "loaded_max_price",
+    "loaded_limit"
+)
+
 # Use loaded values if available, otherwise use defaults
 selected_category = st.selectbox(
     "Category", 
-    options=list(category_options.keys()),
-    index=list(category_options.keys()).index(st.session_state.get('loaded_category', 'All Categories'))
+    options=CATEGORY_KEYS,
+    index=CATEGORY_INDEX.get(st.session_state.get('loaded_category', 'All Categories'), 0)
 )
 
 listing_type_filter = st.selectbox(
     "Filter by listing type",
-    ["All", "Auction", "Fixed Price", "Best Offer"],
-    index=["All", "Auction", "Fixed Price", "Best Offer"].index(st.session_state.get('loaded_listing_type', 'All'))
+    LISTING_TYPES,
+    index=LISTING_TYPE_INDEX.get(st.session_state.get('loaded_listing_type', 'All'), 0)
 )
 
 # NEW: Seller Type filter
 seller_type_filter = st.selectbox(
     "Seller Type",
-    ["All", "Charity"],
-    index=["All", "Charity"].index(st.session_state.get('loaded_seller_type', 'All')),
+    SELLER_TYPES,
+    index=SELLER_TYPE_INDEX.get(st.session_state.get('loaded_seller_type', 'All'), 0),
     help="Charity includes Goodwill, Salvation Army, Habitat for Humanity, St. Vincent de Paul, Catholic Charities, and other nonprofit thrift stores"
 )
 
@@ -280,7 +392,7 @@ max_price = st.number_input(
 limit = st.slider(
     "Number of listings to fetch:", 
     min_value=1, 
-    max_value=100, 
+    max_value=500, 
     value=st.session_state.get('loaded_limit', 25)
 )
 
@@ -315,9 +427,8 @@ aspect_map = {
 # Execute search
 if search_clicked:
     # Clear loaded values AFTER search is clicked, not before
-    for key in list(st.session_state.keys()):
-        if key.startswith('loaded_'):
-            del st.session_state[key]
+    for key in LOADED_KEYS:
+        st.session_state.pop(key, None)
 
     if not access_token:
         st.error("Unable to search - missing access token")
@@ -357,100 +468,84 @@ if search_clicked:
 
 
 
-        params = {
-            "q": query,
-            "filter": ",".join(filters),
-            "limit": limit
-        }
-
+        filter_str = ",".join(filters)
         category_ids = category_options[selected_category]
-        if category_ids:
-            params["category_ids"] = category_ids
 
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
-        
         with st.spinner("Searching eBay..."):
-            response = requests.get("https://api.ebay.com/buy/browse/v1/item_summary/search", params=params, headers=headers)
-            
-            if response.status_code != 200:
-                st.error(f"API Error: {response.status_code} - {response.text}")
+            try:
+                items = fetch_ebay(query, filter_str, limit, category_ids)
+            except requests.HTTPError as error:
+                st.error(f"API Error: {error.response.status_code} - {error.response.text}")
                 st.write("Debug info:")
                 st.write(f"Query: {query}")
                 st.write(f"Filters: {filters}")
-                st.write(f"Params: {params}")
+                st.write(f"Limit: {limit}")
+                st.write(f"Category IDs: {category_ids}")
             else:
-                items = response.json().get("itemSummaries", [])
-
-                results = []
-                for item in items:
-                    title = item.get("title", "")
-                    price = float(item.get("price", {}).get("value", 0.0))
-                    shipping = float(item.get("shippingOptions", [{}])[0].get("shippingCost", {}).get("value", 0.0))
-                    total_cost = price + shipping
-                    link = item.get("itemWebUrl")
-                    buying_options = item.get("buyingOptions", [])
-                   
-                    # Filter out for parts not working (condition ID: 7000)
-                    condition_id = item.get("conditionId")
-                    if condition_id == "7000":
-                        continue
-                    
-
-                    # Get seller information
-                    seller_info = item.get("seller", {})
-                    seller_username = seller_info.get("username", "")
-                    seller_feedback_score = seller_info.get("feedbackScore", 0)
-                    seller_feedback_percent = seller_info.get("feedbackPercentage", 0)
-
-                     # Apply seller type filter - filter results by seller username
-                    if seller_type_filter == "Charity" and not is_charity_seller(seller_username):
-                        continue
-                    
-                    # Categorize seller
-                    seller_category = categorize_seller(seller_feedback_score, seller_feedback_percent)
-                    
-                    # Apply seller rating filter
-                    if seller_rating_filter and seller_category not in seller_rating_filter:
-                        continue
-
-                    end_time_str = item.get("itemEndDate")
-                    end_time = "N/A"
-                    if "AUCTION" in buying_options and end_time_str:
-                        try:
-                            utc_dt = datetime.datetime.fromisoformat(end_time_str.replace("Z", "+00:00"))
-                            central = pytz.timezone('US/Central')
-                            local_dt = utc_dt.astimezone(central)
-                            end_time = local_dt.strftime("%Y-%m-%d %I:%M %p %Z")
-                        except Exception:
-                            end_time = "Invalid date"
-
-                    bid_count = item.get("bidCount") if "AUCTION" in buying_options else None
-                    current_bid_price = float(item.get("currentBidPrice", {}).get("value", 0.0)) if "AUCTION" in buying_options else None
-                    total_bid_cost = current_bid_price + shipping if current_bid_price is not None else None
-                    
-                    if total_cost <= max_price:
-                        results.append({
-                            "listing": title,
-                            "condition": item.get("condition"),
-                            "price": price,
-                            "current_bid_price": current_bid_price,
-                            "listing_type": ", ".join(buying_options),
-                            "bid_count": bid_count,
-                            "auction_end_time": end_time,
-                            "seller": seller_username,
-                            "seller_rating": seller_category,
-                            "seller_feedback": seller_feedback_percent,
-                            "seller_feedback_score": seller_feedback_score,
-                            "link": link
-                        })
-
-                if results and listing_type_filter != "Auction":
-                    df = pd.DataFrame(results)
-                    df = df.sort_values(by="price").reset_index(drop=True)
+                # Flatten nested fields (price.value -> price_value, seller.username -> seller_username, ...)
+                raw = pd.json_normalize(items, sep='_')
+
+                buying_options = [
+                    options if isinstance(options, list) else []
+                    for options in get_column(raw, "buyingOptions")
+                ]
+                is_auction = pd.Series(["AUCTION" in options for options in buying_options], index=raw.index)
+
+                # Numeric fields; missing or malformed values count as 0
+                price = pd.to_numeric(get_column(raw, "price_value"), errors='coerce').fillna(0.0)
+                shipping_costs = get_column(raw, "shippingOptions").str[0].str.get("shippingCost").str.get("value")
+                shipping = pd.to_numeric(shipping_costs, errors='coerce').fillna(0.0)
+                total_cost = price + shipping
+                current_bid_price = pd.to_numeric(get_column(raw, "currentBidPrice_value"), errors='coerce').fillna(0.0)
+
+                # Auction end times in US/Central; other listing types show N/A
+                end_time_strs = get_column(raw, "itemEndDate").where(is_auction)
+                end_dts = pd.to_datetime(end_time_strs, utc=True, errors='coerce', format="ISO8601")
+                end_times = (
+                    end_dts.dt.tz_convert(CENTRAL_TZ)
+                    .dt.strftime("%Y-%m-%d %I:%M %p %Z")
+                    .fillna("N/A")
+                    .mask(end_dts.isna() & end_time_strs.notna(), "Invalid date")
+                )
+
+                seller_feedback_score = get_column(raw, "seller_feedbackScore", 0).fillna(0)
+                seller_feedback_percent = get_column(raw, "seller_feedbackPercentage", 0).fillna(0)
+                sellers = get_column(raw, "seller_username", "").fillna("")
+                seller_ratings = pd.Series(
+                    categorize_sellers(seller_feedback_score, seller_feedback_percent),
+                    index=raw.index
+                )
+
+                # Filter out for parts not working (condition ID: 7000) and listings over max total price
+                mask = (get_column(raw, "conditionId") != "7000") & (total_cost <= max_price)
+
+                # Apply seller type filter - filter results by seller username
+                if seller_type_filter == "Charity":
+                    mask &= sellers.str.contains(CHARITY_RE, na=False)
+
+                # Apply seller rating filter
+                if seller_rating_filter:
+                    mask &= seller_ratings.isin(seller_rating_filter)
+
+                # Build the results column by column from the rows that passed the filters
+                df = pd.DataFrame({
+                    "listing": get_column(raw, "title", "").fillna("")[mask],
+                    "condition": get_column(raw, "condition")[mask],
+                    "price": price[mask].astype("float64"),
+                    "current_bid_price": current_bid_price.where(is_auction)[mask].astype("float64"),
+                    "listing_type": pd.Series([", ".join(options) for options in buying_options], index=raw.index)[mask],
+                    "bid_count": pd.to_numeric(get_column(raw, "bidCount"), errors='coerce').where(is_auction)[mask].astype("Int32"),
+                    "auction_end_time": end_times[mask],
+                    "seller": sellers[mask],
+                    "seller_rating": seller_ratings[mask],
+                    "seller_feedback": seller_feedback_percent[mask],
+                    "seller_feedback_score": pd.to_numeric(seller_feedback_score, errors='coerce')[mask].astype("Int64"),
+                    "link": get_column(raw, "itemWebUrl")[mask]
+                }, copy=False)
+
+                if not df.empty and listing_type_filter != "Auction":
                     df = df.drop(columns=['current_bid_price', 'bid_count', 'auction_end_time', 'total_bid_cost'], errors='ignore')
+                    df = df.sort_values(by="price", ignore_index=True)
 
                     # Price Analytics Dashboard
                     st.header("📊 Price Analytics")
@@ -464,15 +559,7 @@ if search_clicked:
                         st.info(f"🏪 Showing {charity_count} listings from charity stores (Goodwill & Salvation Army)")
                     
                     # Format currency columns
-                    def format_currency(val):
-                        return f"${val:,.2f}"
-                    
-                    df_display = df.copy()
-                    for col in ["price"]:
-                        if col in df_display.columns:
-                            df_display[col] = df_display[col].apply(format_currency)
-
-                    styled_df = df_display.style.set_properties(
+                    styled_df = df.style.format({"price": "${:,.2f}"}).set_properties(
                         **{"text-align": "center", "white-space": "pre-wrap"}
                     ).set_table_styles([
                         {"selector": "th", "props": [("font-weight", "bold"), ("text-align", "center")]}
@@ -487,7 +574,7 @@ if search_clicked:
                     )
                     
                     # Export functionality
-                    csv = df.to_csv(index=False)
+                    csv = to_csv_bytes(df)
                     st.download_button(
                         "📥 Download Results as CSV",
                         csv,
@@ -495,17 +582,16 @@ if search_clicked:
                         "text/csv"
                     )
                     
-                    success_message = f"Found {len(results)} listings"
+                    success_message = f"Found {len(df)} listings"
                     if seller_type_filter == "Charity":
                         success_message += " from charity stores"
                     st.success(success_message)
 
-                elif results and listing_type_filter == "Auction": 
+                elif not df.empty and listing_type_filter == "Auction": 
                     st.header("📋 Auction Listings")
                     
-                    df = pd.DataFrame(results)
                     df = df.drop(columns=['price', 'total_cost'], errors='ignore')
-                    df = df.sort_values(by="auction_end_time", ascending=True, na_position="last").reset_index(drop=True)
+                    df = df.sort_values(by="auction_end_time", ascending=True, na_position="last", ignore_index=True)
 
                      # Show charity filter status if applied
                     if seller_type_filter == "Charity":
@@ -514,15 +600,7 @@ if search_clicked:
 
 
                     # Format currency columns
-                    def format_currency(val):
-                        return f"${val:,.2f}"
-                    
-                    df_display = df.copy()
-                    for col in ["price", "current_bid_price"]:
-                        if col in df_display.columns:
-                            df_display[col] = df_display[col].apply(format_currency)
-
-                    styled_df = df_display.style.set_properties(
+                    styled_df = df.style.format({"current_bid_price": "${:,.2f}"}, na_rep="N/A").set_properties(
                         **{"text-align": "center", "white-space": "pre-wrap"}
                     ).set_table_styles([
                         {"selector": "th", "props": [("font-weight", "bold"), ("text-align", "center")]}
@@ -537,7 +615,7 @@ if search_clicked:
                     )
                     
                     # Export functionality
-                    csv = df.to_csv(index=False)
+                    csv = to_csv_bytes(df)
                     st.download_button(
                         "📥 Download Results as CSV",
                         csv,
@@ -545,7 +623,7 @@ if search_clicked:
                         "text/csv"
                     )
                     
-                    success_message = f"Found {len(results)} auction listings"
+                    success_message = f"Found {len(df)} auction listings"
                     if seller_type_filter == "Charity":
                         success_message += " from charity stores"
                     st.success(success_message)